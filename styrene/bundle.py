@@ -33,6 +33,7 @@ import sys
 import glob
 import shutil
 import functools
+import threading
 from textwrap import dedent
 
 import logging
@@ -65,6 +66,17 @@ ARCH_OPTS = {
     ],
 }
 
+# pacman doesn't lock its package cache, and bundle trees share the
+# user's own. Parallel builds replace this with a lock shared across
+# processes, so that only one can download into the cache at a time.
+_package_cache_lock = threading.Lock()
+
+
+def set_package_cache_lock(lock):
+    """Sets the lock held while installing packages into bundle trees."""
+    global _package_cache_lock
+    _package_cache_lock = lock
+
 
 # Class defs:
 
@@ -478,21 +490,22 @@ class NativeBundle:
             else:
                 remaining_packages.add(pkg_name)
 
-        if local_package_paths:
-            cmd = ["pacman", "--upgrade"]
-            cmd += cmd_common
-            cmd += list(local_package_paths)
-            logger.debug("Running “%s”…", " ".join(cmd))
-            subprocess.check_call(cmd)
-
-        if remaining_packages:
-            cmd = ["pacman", "--sync", "--quiet"]
-            cmd += cmd_common
-            cmd += list(remaining_packages)
-            if local_packages:
-                cmd += ["--ignore", ",".join(local_packages)]
-            logger.debug("Running “%s”…", " ".join(cmd))
-            subprocess.check_call(cmd)
+        with _package_cache_lock:
+            if local_package_paths:
+                cmd = ["pacman", "--upgrade"]
+                cmd += cmd_common
+                cmd += list(local_package_paths)
+                logger.debug("Running “%s”…", " ".join(cmd))
+                subprocess.check_call(cmd)
+
+            if remaining_packages:
+                cmd = ["pacman", "--sync", "--quiet"]
+                cmd += cmd_common
+                cmd += list(remaining_packages)
+                if local_packages:
+                    cmd += ["--ignore", ",".join(local_packages)]
+                logger.debug("Running “%s”…", " ".join(cmd))
+                subprocess.check_call(cmd)
 
     @staticmethod
     def _vercmp(v1, v2):
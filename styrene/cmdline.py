@@ -18,22 +18,44 @@
 
 """Launching from the command line."""
 
-from .bundle import NativeBundle
-from .utils import fix_tree_perms
-
-import optparse
-import configparser
+import argparse
 import sys
 import os.path
 import os
-import tempfile
-import shutil
-from textwrap import dedent
 import re
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Console formatters, keyed by (colourize, log_format), reused if logging
+# is initialized more than once in the same process.
+_FORMATTER_CACHE = {}
+
+# The console handler installed on the root logger by init_logging().
+_console_handler = None
+
+# Help text for main()'s parser, written without indentation
+# so that it needs no dedent() at startup:
+
+_DESCRIPTION = """\
+Creates distributable installers and portable zipfiles
+by bundling together MSYS2 packages."""
+
+_EPILOG = """\
+Normally a temp directory is used for building,
+and the output distributables are then moved
+into the current directory.
+The temp dir is normally deleted after processing.
+
+Specifying --output-dir changes this behaviour:
+no temp directory will be made.
+The output dir will be created if it doesn't exist,
+and all output will be retained there, not moved out.
+The temporary bundle tree is kept too,
+for inspection and testing.
+
+More: http://styrene.readthedocs.io/"""
+
 
 class ColorFormatter (logging.Formatter):
     """Minimal ANSI formatter, for use with non-Windows console logging."""
@@ -58,8 +80,26 @@ class ColorFormatter (logging.Formatter):
     UNDERLINEOFF = "\033[24m"
     RESET = "\033[0m"
 
+    # Extra LogRecord attributes, for use in format strings:
+
+    _ANSI_ATTRS = {
+        "reset": RESET,
+        "bold": BOLD,
+        "boldOff": BOLDOFF,
+        "italic": ITALIC,
+        "italicOff": ITALICOFF,
+        "underline": UNDERLINE,
+        "underlineOff": UNDERLINEOFF,
+    }
+
+    # Record attributes that format() changes, and puts back afterwards:
+
+    _TRANSIENT_ATTRS = ("msg", "message", "levelCol") + tuple(_ANSI_ATTRS)
+
     # Token formatting:
 
+    _FORMAT_TOKEN_RE = re.compile(r'%r|%s|%\+?[0-9.]*[df]')
+
     @classmethod
     def replace_bold(cls, m):
         return cls.BOLD + m.group(0) + cls.BOLDOFF
@@ -75,35 +115,36 @@ class ColorFormatter (logging.Formatter):
     # Formatter methods:
 
     def format(self, record):
-        record = logging.makeLogRecord(record.__dict__)
+        # Decorate the record in place, restoring it afterwards so that
+        # other handlers and filters still see plain text, and none of
+        # our extra attributes.
+        attrs = record.__dict__
+        saved = {k: attrs[k] for k in self._TRANSIENT_ATTRS if k in attrs}
+        # Messages needn't be strings, and most have no tokens at all.
         msg = record.msg
-        replace = self.replace_bold
-        token_formatting = [
-            (re.compile(r'%r'), replace),
-            (re.compile(r'%s'), replace),
-            (re.compile(r'%\+?[0-9.]*d'), replace),
-            (re.compile(r'%\+?[0-9.]*f'), replace),
-        ]
-        for token_re, repl in token_formatting:
-            msg = token_re.sub(repl, msg)
-        record.msg = msg
-        record.reset = self.RESET
-        record.bold = self.BOLD
-        record.boldOff = self.BOLDOFF
-        record.italic = self.ITALIC
-        record.italicOff = self.ITALICOFF
-        record.underline = self.UNDERLINE
-        record.underlineOff = self.UNDERLINEOFF
-        record.levelCol = ""
-        if record.levelname in self.LEVELCOL:
-            record.levelCol = self.LEVELCOL[record.levelname]
-        return super(ColorFormatter, self).format(record)
+        if isinstance(msg, str) and "%" in msg:
+            record.msg = self._FORMAT_TOKEN_RE.sub(self.replace_bold, msg)
+        attrs.update(self._ANSI_ATTRS)
+        record.levelCol = self.LEVELCOL.get(record.levelname, "")
+        try:
+            return super(ColorFormatter, self).format(record)
+        finally:
+            for k in self._TRANSIENT_ATTRS:
+                attrs.pop(k, None)
+            attrs.update(saved)
 
 
 # Top-level commands:
 
 def process_spec_file(spec, options):
     """Prepare the bundle as specified in the spec."""
+    # The bundle machinery is imported here rather than at module level
+    # so that --help and usage errors don't have to pay for loading it.
+    from .bundle import NativeBundle
+    from .utils import fix_tree_perms
+    import tempfile
+    import shutil
+
     bundle = NativeBundle(spec)
     bundle.check_runtime_dependencies()
     output_dir = options.output_dir
@@ -129,61 +170,171 @@ def process_spec_file(spec, options):
                     output_dir,
                     os.path.basename(distfile),
                 )
-                shutil.copy(distfile, distfile_final)
+                # The temp dir is about to be deleted, so move rather
+                # than copy: a plain rename if it's on the same device.
+                shutil.move(distfile, distfile_final)
         finally:
             logger.info("Cleaning up “%s”", tmp_dir)
-            fix_tree_perms(tmp_dir)
-            shutil.rmtree(tmp_dir)
+            try:
+                shutil.rmtree(tmp_dir)
+            except OSError:
+                # Usually read-only files or folders. Only walk the tree
+                # to fix them up if removal actually fails.
+                fix_tree_perms(tmp_dir)
+                shutil.rmtree(tmp_dir)
     else:
         bundle.write_distributables(output_dir, options)
 
 
+def load_spec_file(spec_file):
+    """Load a bundle spec file, raising an exception on failure."""
+    import configparser
+    spec = configparser.ConfigParser()
+    with open(spec_file, "r", encoding="utf-8") as fp:
+        spec.read_file(fp)
+    return spec
+
+
+class _SpecFileLogFilter (logging.Filter):
+    """Prefixes log record names with the spec file being processed."""
+
+    def __init__(self, spec_file):
+        super(_SpecFileLogFilter, self).__init__()
+        self.spec_file = spec_file
+
+    def filter(self, record):
+        record.name = "%s: %s" % (self.spec_file, record.name)
+        return True
+
+
+def _init_worker(options, package_cache_lock):
+    """Worker process initializer for process_spec_files_in_parallel()."""
+    from .bundle import set_package_cache_lock
+    init_logging(options)
+    set_package_cache_lock(package_cache_lock)
+
+
+def _load_and_process_spec_file(spec_file, options):
+    """Worker process entry point for process_spec_files_in_parallel()."""
+    log_filter = _SpecFileLogFilter(spec_file)
+    _console_handler.addFilter(log_filter)
+    try:
+        process_spec_file(load_spec_file(spec_file), options)
+    finally:
+        _console_handler.removeFilter(log_filter)
+
+
+def process_spec_files_in_parallel(spec_files, options):
+    """Process several spec files at once, in worker processes.
+
+    Each worker loads its own spec file, since ConfigParser objects
+    don't pickle. Package installs take turns, because the workers
+    share the user's pacman package cache. Every bundle is built in a
+    temp dir of its own; main() refuses --jobs with --output-dir.
+
+    After the first failure, specs that haven't started are cancelled,
+    but ones already running are allowed to finish so that they can
+    clean up their temp dirs. Then styrene exits with status 2.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import as_completed
+
+    max_workers = min(options.jobs, len(spec_files))
+    package_cache_lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(options, package_cache_lock),
+    ) as executor:
+        futures = {
+            executor.submit(_load_and_process_spec_file, f, options): f
+            for f in spec_files
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(
+                    "Failed to process “%s”",
+                    futures[future],
+                )
+                logger.info("Waiting for running bundles to finish…")
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(2)
+
+
 # Startup:
 
+def init_logging(options):
+    """Set up console logging as requested by the command line options."""
+    colspec = options.colour.casefold()
+    if colspec == "yes".casefold():
+        colourize = True
+    elif colspec == "no".casefold():
+        colourize = False
+    else:
+        colourize = sys.stderr.isatty()
+    if colourize:
+        log_format = (
+            "%(levelCol)s%(levelname)s: "
+            "%(bold)s%(name)s%(boldOff)s: "
+            "%(message)s%(reset)s"
+        )
+    else:
+        log_format = "%(levelname)s: %(name)s: %(message)s"
+    cache_key = (colourize, log_format)
+    console_formatter = _FORMATTER_CACHE.get(cache_key)
+    if console_formatter is None:
+        if colourize:
+            console_formatter = ColorFormatter(log_format)
+        else:
+            console_formatter = logging.Formatter(log_format)
+        _FORMATTER_CACHE[cache_key] = console_formatter
+    global _console_handler
+    root_logger = logging.getLogger(None)
+    if _console_handler is None:
+        _console_handler = logging.StreamHandler(stream=sys.stderr)
+    if _console_handler not in root_logger.handlers:
+        root_logger.addHandler(_console_handler)
+    _console_handler.setFormatter(console_formatter)
+    if options.quiet:
+        loglevel = logging.WARNING
+    elif options.debug:
+        loglevel = logging.DEBUG
+    else:
+        loglevel = logging.INFO
+    root_logger.setLevel(loglevel)
+
+
 def main():
 
     # Parse command line args
-    parser = optparse.OptionParser(
-        usage="%prog [options] spec1.cfg ...",
-        description=dedent("""
-            Creates distributable installers and portable zipfiles
-            by bundling together MSYS2 packages.
-        """).strip(),
-        epilog=dedent("""
-            Normally a temp directory is used for building,
-            and the output distributables are then copied
-            into the current directory.
-            The temp dir is normally deleted after processing.
-
-            Specifying --output-dir changes this behaviour:
-            no temp directory will be made.
-            The output dir will be created if it doesn't exist,
-            and all output will be retained there, not copied out.
-            The temporary bundle tree is kept too,
-            for inspection and testing.
-
-            More: http://styrene.readthedocs.io/
-        """).strip(),
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] spec1.cfg ...",
+        description=_DESCRIPTION,
+        epilog=_EPILOG,
     )
-    parser.add_option(
+    parser.add_argument(
         "-q", "--quiet",
         help="log errors and warnings only",
         action="store_true",
         default=False,
     )
-    parser.add_option(
+    parser.add_argument(
         "--debug",
         help="debug mode (noisy operation, pause after postinst)",
         action="store_true",
         default=False,
     )
-    parser.add_option(
+    parser.add_argument(
         "-o", "--output-dir",
         help="where to store output, created if needed",
         metavar="DIR",
         default=None,
     )
-    parser.add_option(
+    parser.add_argument(
         "-p", "--pkg-dir",
         metavar="DIR",
         help="preferentially use package files from DIR",
@@ -191,63 +342,61 @@ def main():
         dest="pkgdirs",
         default=[],
     )
-    parser.add_option(
+    parser.add_argument(
         "--no-exe",
         help="do not build the installer .exe output",
         action="store_false",
         dest="build_exe",
         default=True,
     )
-    parser.add_option(
+    parser.add_argument(
         "--no-zip",
         help="do not create the standalone .zip output",
         action="store_false",
         dest="build_zip",
         default=True,
     )
-    parser.add_option(
+    parser.add_argument(
         "--colour", "--color",
         help="colourize output: yes/no/auto",
         metavar="COLSPEC",
         default="auto",
     )
-    options, args = parser.parse_args(sys.argv[1:])
+    parser.add_argument(
+        "-j", "--jobs",
+        help="process up to N spec files in parallel",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "spec_files",
+        help="bundle specification files to process",
+        metavar="spec.cfg",
+        nargs="*",
+    )
+    options = parser.parse_intermixed_args(sys.argv[1:])
+    args = options.spec_files
     if not len(args):
         parser.print_help()
         sys.exit(1)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.jobs > 1 and options.output_dir:
+        # Parallel builds would share one output dir, and with it the
+        # NSIS include files and any bundle trees with the same name.
+        parser.error("--jobs cannot be used with --output-dir")
 
     # Initialize logging
-    colourize = {
-        "yes".casefold(): True,
-        "no".casefold(): False,
-    }.get(options.colour.casefold(), sys.stderr.isatty())
-    if colourize:
-        log_format = (
-            "%(levelCol)s%(levelname)s: "
-            "%(bold)s%(name)s%(boldOff)s: "
-            "%(message)s%(reset)s"
-        )
-        console_formatter = ColorFormatter(log_format)
-    else:
-        log_format = "%(levelname)s: %(name)s: %(message)s"
-        console_formatter = logging.Formatter(log_format)
-    console_handler = logging.StreamHandler(stream=sys.stderr)
-    console_handler.setFormatter(console_formatter)
-    root_logger = logging.getLogger(None)
-    root_logger.addHandler(console_handler)
-    if options.quiet:
-        loglevel = logging.WARNING
-    elif options.debug:
-        loglevel = logging.DEBUG
-    else:
-        loglevel = logging.INFO
-    root_logger.setLevel(loglevel)
+    init_logging(options)
 
     # Process bundles
+    if options.jobs > 1 and len(args) > 1:
+        process_spec_files_in_parallel(args, options)
+        return
     for spec_file in args:
         try:
-            spec = configparser.ConfigParser()
-            spec.read(spec_file, encoding="utf-8")
+            spec = load_spec_file(spec_file)
         except Exception:
             logger.exception(
                 "Failed to load bundle spec file “%s”",